@@ -22,11 +22,15 @@ def get_default_configs():
     training.pmap = False
     training.reduce_mean = True
     training.pointwise_t = False
+    ## recompute activations in the backward pass to save memory, e.g., for the CNN
+    training.remat = False
 
     # sampling
     config.sampling = sampling = ml_collections.ConfigDict()
     sampling.stack_samples = False
     sampling.denoise = True
+    ## run the network in bfloat16, with bfloat16 parameters, for snapshot sampling during training
+    sampling.bf16_params = False
 
     # evaluation
     config.eval = evaluate = ml_collections.ConfigDict()
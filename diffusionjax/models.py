@@ -1,10 +1,14 @@
 """Functions are designed for a mini-batch of inputs."""
+from typing import Any, Optional
 import flax.linen as nn
 import numpy as np
 import jax.numpy as jnp
 
 
 class MLP(nn.Module):
+  # The computation dtype, e.g., `jnp.bfloat16`, the parameters are stored in float32 by default
+  dtype: Optional[Any] = None
+
   @nn.compact
   def __call__(self, x, t):
     x_shape = x.shape
@@ -14,17 +18,20 @@ class MLP(nn.Module):
     x = x.reshape((x.shape[0], -1))  # flatten
     t = jnp.concatenate([t - 0.5, jnp.cos(2*jnp.pi*t)], axis=-1)
     x = jnp.concatenate([x, t], axis=-1)
-    x = nn.Dense(n_hidden)(x)
+    x = nn.Dense(n_hidden, dtype=self.dtype)(x)
     x = nn.relu(x)
-    x = nn.Dense(n_hidden)(x)
+    x = nn.Dense(n_hidden, dtype=self.dtype)(x)
     x = nn.relu(x)
-    x = nn.Dense(n_hidden)(x)
+    x = nn.Dense(n_hidden, dtype=self.dtype)(x)
     x = nn.relu(x)
-    x = nn.Dense(in_size)(x)
+    x = nn.Dense(in_size, dtype=self.dtype)(x)
     return x.reshape(x_shape)
 
 
 class CNN(nn.Module):
+  # The computation dtype, e.g., `jnp.bfloat16`, the parameters are stored in float32 by default
+  dtype: Optional[Any] = None
+
   @nn.compact
   def __call__(self, x, t):
     x_shape = x.shape
@@ -35,13 +42,13 @@ class CNN(nn.Module):
 
     t = t.reshape((t.shape[0], -1))
     t = jnp.concatenate([t - 0.5, jnp.cos(2*jnp.pi*t)], axis=-1)
-    t = nn.Dense(n_hidden**2 * n_time_channels)(t)
+    t = nn.Dense(n_hidden**2 * n_time_channels, dtype=self.dtype)(t)
     t = nn.relu(t)
-    t = nn.Dense(n_hidden**2 * n_time_channels)(t)
+    t = nn.Dense(n_hidden**2 * n_time_channels, dtype=self.dtype)(t)
     t = nn.relu(t)
     t = t.reshape(t.shape[0], n_hidden, n_hidden, n_time_channels)
     # Add time as another channel
     x = jnp.concatenate((x, t), axis=-1)
     # A single convolution layer
-    x = nn.Conv(x_shape[-1], kernel_size=(9,) * (ndim - 2))(x)
+    x = nn.Conv(x_shape[-1], kernel_size=(9,) * (ndim - 2), dtype=self.dtype)(x)
     return x
@@ -1,7 +1,7 @@
 """Plotting code for the examples."""
 import jax.numpy as jnp
 import matplotlib.pyplot as plt
-from jax import jit, vmap
+from jax import jit
 from functools import partial
 import matplotlib.animation as animation
 import numpy as np
@@ -16,29 +16,60 @@ dpi_val = 1200
 cmap = 'magma'
 
 
+def small_kernel(z, area_bounds, lengthscale):
+  a = jnp.linspace(area_bounds[0], area_bounds[1], 512)
+  # The kernel is separable, exp(-l((x - z_0)^2 + (y - z_1)^2)) = exp(-l(x - z_0)^2) exp(-l(y - z_1)^2),
+  # so broadcast an outer product of the two 1D kernels instead of evaluating on a meshgrid
+  hm_x = jnp.exp(-lengthscale * (a - z[0])**2)
+  hm_y = jnp.exp(-lengthscale * (a - z[1])**2)
+  hm = hm_y[:, None] * hm_x[None, :]
+  return hm
+
+
+# The jitted helpers are defined at module level, rather than inside the plotting
+# functions, so that their compiled code is reused across calls
+@jit  # jit most of the code, but use the helper functions since cannot jit all of it because of plt
+def produce_heatmap(samples, area_bounds, lengthscale):
+  # The sum over samples of the separable kernels of `small_kernel` is a single matmul of the
+  # (num_particles, 512) 1D kernels, so no num_particles x 512 x 512 stack is ever held in memory
+  a = jnp.linspace(area_bounds[0], area_bounds[1], 512)
+  hm_x = jnp.exp(-lengthscale * (a[None, :] - samples[:, 0:1])**2)
+  hm_y = jnp.exp(-lengthscale * (a[None, :] - samples[:, 1:2])**2)
+  return hm_y.T @ hm_x
+
+
+@partial(jit, static_argnames=['score', 'scaler'])  # We can not jit the whole function since plt.quiver cannot be jitted
+def score_on_grid(score, scaler, t, area_bounds):
+  x = jnp.linspace(area_bounds[0], area_bounds[1], 16)
+  x, y = jnp.meshgrid(x, x)
+  grid = jnp.stack([x.flatten(), y.flatten()], axis=1)
+  t = jnp.ones((grid.shape[0],)) * t
+  scores = score(scaler(grid), t)
+  return grid, scores
+
+
+def save_figure(fig, fname, **kwargs):
+  """Saves a figure to fname.png and closes it, so that pyplot does not keep it alive.
+  Args:
+    fig: the matplotlib figure.
+    fname: the file name, without extension.
+    kwargs: passed on to `fig.savefig`.
+  """
+  fig.savefig(fname + '.png', **kwargs)
+  plt.close(fig)
+
+
 def plot_heatmap(samples, area_bounds, lengthscale=350.0, fname="plot_heatmap") -> None:
   """Plots a heatmap of all samples in the area area_bounds x area_bounds.
   Args:
     samples: locations of particles shape (num_particles, 2)
   """
-  def small_kernel(z, area_bounds):
-    a = jnp.linspace(area_bounds[0], area_bounds[1], 512)
-    x, y = jnp.meshgrid(a, a)
-    dist = (x - z[0])**2 + (y - z[1])**2
-    hm = jnp.exp(-lengthscale * dist)
-    return hm
-
-  @jit  # jit most of the code, but use the helper functions since cannot jit all of it because of plt
-  def produce_heatmap(samples, area_bounds):
-    return jnp.sum(vmap(small_kernel, in_axes=(0, None))(samples, area_bounds), axis=0)
-
-  hm = produce_heatmap(samples, area_bounds)
+  hm = produce_heatmap(samples, area_bounds, lengthscale)
   extent = area_bounds + area_bounds
-  plt.imshow(hm, interpolation='nearest', extent=extent)
-  ax = plt.gca()
+  fig, ax = plt.subplots(1, 1)
+  ax.imshow(hm, interpolation='nearest', extent=extent)
   ax.invert_yaxis()
-  plt.savefig(fname + '.png')
-  plt.close()
+  save_figure(fig, fname)
 
 
 def image_grid(x, image_size, num_channels):
@@ -49,12 +80,10 @@ def image_grid(x, image_size, num_channels):
 
 def plot_samples(x, image_size=32, num_channels=3, fname="samples"):
     img = image_grid(x, image_size, num_channels)
-    plt.figure(figsize=(8,8))
-    plt.axis('off')
-    plt.imshow(img, cmap=cmap)
-    plt.savefig(fname + '.png', bbox_inches='tight', pad_inches=0.0)
-    # plt.savefig(fname + '.pdf', bbox_inches='tight', pad_inches=0.0)
-    plt.close()
+    fig, ax = plt.subplots(1, 1, figsize=(8,8))
+    ax.axis('off')
+    ax.imshow(img, cmap=cmap)
+    save_figure(fig, fname, bbox_inches='tight', pad_inches=0.0)
 
 
 def plot_scatter(samples, index, fname="samples", lims=None):
@@ -70,21 +99,17 @@ def plot_scatter(samples, index, fname="samples", lims=None):
   if lims is not None:
     ax.set_xlim(lims[0])
     ax.set_ylim(lims[1])
-  plt.gca().set_aspect('equal', adjustable='box')
-  plt.draw()
-  fig.savefig(
-    fname + '.png',
-    facecolor=fig.get_facecolor(), edgecolor='none')
-  plt.close()
+  ax.set_aspect('equal', adjustable='box')
+  save_figure(fig, fname, facecolor=fig.get_facecolor(), edgecolor='none')
 
 
 def plot_samples_1D(samples, image_size, x_max=5.0, fname="samples 1D", alpha=FG_ALPHA):
   x = np.linspace(-x_max, x_max, image_size)
-  plt.plot(x, samples[..., 0].T, alpha=alpha)
-  plt.xlim(-5., 5.)
-  plt.ylim(-5., 5.)
-  plt.savefig(fname + '.png')
-  plt.close()
+  fig, ax = plt.subplots(1, 1)
+  ax.plot(x, samples[..., 0].T, alpha=alpha)
+  ax.set_xlim(-5., 5.)
+  ax.set_ylim(-5., 5.)
+  save_figure(fig, fname)
 
 
 def plot_animation(fig, ax, animate, frames, fname, fps=20, bitrate=800, dpi=300):
@@ -99,36 +124,16 @@ def plot_animation(fig, ax, animate, frames, fname, fps=20, bitrate=800, dpi=300
 
 def plot_score(score, scaler, t, area_bounds=[-3., 3.], fname="plot_score"):
   fig, ax = plt.subplots(1, 1)
-  # this helper function is here so that we can jit
-  @partial(jit, static_argnums=[0,])  # We can not jit the whole function since plt.quiver cannot be jitted
-  def helper(score, t, area_bounds):
-    x = jnp.linspace(area_bounds[0], area_bounds[1], 16)
-    x, y = jnp.meshgrid(x, x)
-    grid = jnp.stack([x.flatten(), y.flatten()], axis=1)
-    t = jnp.ones((grid.shape[0],)) * t
-    scores = score(scaler(grid), t)
-    return grid, scores
-
-  grid, scores = helper(score, t, area_bounds)
+  grid, scores = score_on_grid(score, scaler, t, area_bounds)
   ax.quiver(grid[:, 0], grid[:, 1], scores[:, 0], scores[:, 1])
   ax.set_xlabel(r"$x_0$")
   ax.set_ylabel(r"$x_1$")
-  plt.gca().set_aspect('equal', adjustable='box')
-  fig.savefig(fname + '.png')
-  plt.close()
+  ax.set_aspect('equal', adjustable='box')
+  save_figure(fig, fname)
 
 
 def plot_score_ax(ax, score, scaler, t, area_bounds=[-3., 3.]):
-  @partial(jit, static_argnums=[0,])  # We can not jit the whole function since plt.quiver cannot be jitted
-  def helper(score, t, area_bounds):
-    x = jnp.linspace(area_bounds[0], area_bounds[1], 16)
-    x, y = jnp.meshgrid(x, x)
-    grid = jnp.stack([x.flatten(), y.flatten()], axis=1)
-    t = jnp.ones((grid.shape[0],)) * t
-    scores = score(scaler(grid), t)
-    return grid, scores
-
-  grid, scores = helper(score, t, area_bounds)
+  grid, scores = score_on_grid(score, scaler, t, area_bounds)
   ax.quiver(grid[:, 0], grid[:, 1], scores[:, 0], scores[:, 3])
   ax.set_xlabel(r"$x_0$")
   ax.set_ylabel(r"$x_1$")
@@ -139,21 +144,9 @@ def plot_heatmap_ax(ax, samples, area_bounds=[-3., 3.], lengthscale=350):
   Args:
     samples: locations of all particles in R^2, array (J, 2)
   """
-  def small_kernel(z, area_bounds):
-    a = jnp.linspace(area_bounds[0], area_bounds[1], 512)
-    x, y = jnp.meshgrid(a, a)
-    dist = (x - z[0])**2 + (y - z[1])**2
-    hm = jnp.exp(-lengthscale * dist)
-    return hm
-
-  @jit
-  def produce_heatmap(samples, area_bounds):
-    return jnp.sum(vmap(small_kernel, in_axes=(0, None, None))(samples, area_bounds), axis=0)
-
-  hm = produce_heatmap(samples, area_bounds)
+  hm = produce_heatmap(samples, area_bounds, lengthscale)
   extent = area_bounds + area_bounds
   ax.imshow(hm, interpolation='nearest', extent=extent)
-  ax = plt.gca()
   ax.invert_yaxis()
   ax.set_xlabel(r"$x_0$")
   ax.set_ylabel(r"$x_1$")
@@ -167,10 +160,10 @@ def plot_temperature_schedule(sde, solver):
   """
   m2 = sde.mean_coeff(solver.ts)**2
   v = sde.variance(solver.ts)
-  plt.plot(solver.ts, m2, label="m2")
-  plt.plot(solver.ts, v, label="v")
-  plt.legend()
-  plt.savefig("plot_temperature_schedule.png")
-  plt.close()
+  fig, ax = plt.subplots(1, 1)
+  ax.plot(solver.ts, m2, label="m2")
+  ax.plot(solver.ts, v, label="v")
+  ax.legend()
+  save_figure(fig, "plot_temperature_schedule")
 
 
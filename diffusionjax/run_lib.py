@@ -1,8 +1,16 @@
 """Training and evaluation for score-based generative models."""
+import os
+# Snapshot sampling allocates its own buffers next to the training state, so leave
+# headroom in the default GPU preallocation. XLA reads the variable when jax initializes
+# its backend (on the first computation or device query, not on `import jax`), so this
+# has no effect if a backend is already up by the time run_lib is imported. An explicit
+# `XLA_PYTHON_CLIENT_MEM_FRACTION` takes precedence.
+os.environ.setdefault("XLA_PYTHON_CLIENT_MEM_FRACTION", "0.80")
 import jax
-from jax import jit, value_and_grad
+from jax import value_and_grad
 import jax.random as random
 import jax.numpy as jnp
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
 from diffusionjax.utils import (
   get_loss, get_score, get_sampler, get_times,
   get_sigma_function, get_linear_beta_function)
@@ -11,57 +19,58 @@ import diffusionjax.sde as sde_lib
 from diffusionjax.solvers import EulerMaruyama, Annealed, DDIMVP, DDIMVE, SMLD, DDPM
 import numpy as np
 from functools import partial
+import collections
+import concurrent.futures
+import itertools
 import flax
-import flax.training.orbax_utils as orbax_utils
-import flax.jax_utils as flax_utils
-from absl import flags
 from tqdm import tqdm, trange
-import os
 import time
 from typing import Any
 import logging
-import wandb
 
 # This run_library requires optax, https://optax.readthedocs.io/en/latest/
 import optax
-# This run_library requires orbax, https://orbax.readthedocs.io/en/latest/
-import orbax.checkpoint
 # This run_library requires torch[cpu], https://pytorch.org/get-started/locally/
 from torch.utils.data import DataLoader
+# wandb and orbax are imported in `train`, only when asked for, to keep import times short
 
 
-FLAGS = flags.FLAGS
 logger = logging.getLogger(__name__)
 
 
-def get_step_fn(loss, optimizer, train, pmap):
+def get_step_fn(loss, optimizer, train, n_jitted_steps=1):
   """Create a one-step training/evaluation function.
 
+  The loss is a mean over the global batch, so when the batch is sharded across
+  jax devices the gradient all-reduce is inserted by XLA and no explicit
+  collective is needed.
+
   Args:
     loss: A loss function.
     optimizer: An optimization function.
     train: `True` for training and `False` for evaluation.
-    pmap: `True` for pmap across jax devices, `False` for single device.
+    n_jitted_steps: Number of steps fused into one call with `jax.lax.scan`. If greater
+      than one, the batch must have a leading axis of size `n_jitted_steps`.
 
   Returns:
-    A one-step function for training or evaluation.
+    A function for training or evaluation, mapping `(state, batch)` to `(state, loss)`,
+    where `state` is a `State`. Training advances `state.step` and `state.rng` on the device.
+    It is not jitted, so that the caller stages it (and any scan) in a single `jax.jit`.
   """
-  @jit
-  def step_fn(carry, batch):
-    (rng, params, opt_state) = carry
-    rng, step_rng = random.split(rng)
+  def step_fn(state, batch):
+    rng, step_rng = random.split(state.rng)
     grad_fn = value_and_grad(loss)
     if train:
-      loss_val, grads = grad_fn(params, step_rng, batch)
-      if pmap:
-        loss_val = jax.lax.pmean(loss_val, axis_name='batch')
-        grads = jax.lax.pmean(grads, axis_name='batch')
-      updates, opt_state = optimizer.update(grads, opt_state)
-      params = optax.apply_updates(params, updates)
+      loss_val, grads = grad_fn(state.params, step_rng, batch)
+      updates, opt_state = optimizer.update(grads, state.opt_state)
+      params = optax.apply_updates(state.params, updates)
+      state = state.replace(step=state.step + 1, opt_state=opt_state, params=params, rng=rng)
     else:
-      loss_val = loss(params, step_rng, batch)
-      if pmap: loss_val = jax.lax.pmean(loss_val, axis_name='batch')
-    return (rng, params, opt_state), loss_val
+      loss_val = loss(state.params, step_rng, batch)
+    return state, loss_val
+
+  if n_jitted_steps > 1:
+    return partial(jax.lax.scan, step_fn)
   return step_fn
 
 
@@ -72,7 +81,6 @@ class State:
   opt_state: Any
   params: Any
   rng: Any
-  lr: float
 
 
 def get_sde(config):
@@ -190,15 +198,41 @@ def numpy_collate(batch):
 
 
 def jit_collate(n_jitted_steps, batch_size, batch):
-  return np.reshape(batch, (n_jitted_steps, batch_size, -1))
+  # Stack once with `numpy_collate`, then split off the jitted steps axis without a copy
+  return jax.tree_util.tree_map(
+    lambda x: np.reshape(x, (n_jitted_steps, batch_size, -1)), numpy_collate(batch))
+
 
+def prefetch_to_sharding(iterator, sharding, size=2):
+  """Place batches from `iterator` on the devices of `sharding` ahead of time.
 
-def pmap_and_jit_collate(num_devices, n_jitted_steps, per_device_batch_size, batch):
-  return np.reshape(batch, (num_devices, n_jitted_steps, per_device_batch_size, -1))
+  Each batch is transferred with a single asynchronous `jax.device_put`, which
+  copies every shard to its device in parallel, and up to `size` batches are kept
+  in flight so that host to device transfers overlap with the training step.
+
+  Args:
+    iterator: An iterator of host (NumPy) batches in their global layout.
+    sharding: A `jax.sharding.Sharding` for the batches.
+    size: Number of batches to transfer ahead of time.
+  Returns:
+    A generator of device arrays.
+  """
+  queue = collections.deque()
 
+  def enqueue(n):
+    for batch in itertools.islice(iterator, n):
+      queue.append(jax.device_put(batch, sharding))
 
-def pmap_collate(num_devices, per_device_batch_size, batch):
-  return np.reshape(batch, (num_devices, per_device_batch_size, -1))
+  enqueue(size)
+  while queue:
+    yield queue.popleft()
+    enqueue(1)
+
+
+def save_sample(path, sample):
+  """Copy `sample` from the devices to the host and save it to `path` with `np.save`."""
+  with open(path, 'wb') as infile:
+    np.save(infile, np.asarray(sample))
 
 
 class NumpyLoader(DataLoader):
@@ -208,16 +242,8 @@ class NumpyLoader(DataLoader):
                pin_memory=False, drop_last=False,
                timeout=0, worker_init_fn=None):
     prod_batch_dims = config.training.batch_size * config.training.n_jitted_steps
-    if config.training.pmap and config.training.n_jitted_steps != 1:
-      collate_fn = partial(
-        pmap_and_jit_collate, jax.local_device_count(),
-        config.training.n_jitted_steps,
-        config.training.batch_size // jax.local_device_count())
-    elif config.training.pmap and config.training.n_jitted_steps==1:
-      collate_fn = partial(
-        pmap_collate, jax.local_device_count(),
-        config.training.batch_size // jax.local_device_count())
-    elif config.training.n_jitted_steps != 1:
+    # Batches keep their global layout, the batch axis is sharded across devices in `train`
+    if config.training.n_jitted_steps != 1:
       collate_fn = partial(
         jit_collate, config.training.n_jitted_steps, config.training.batch_size)
     else:
@@ -237,7 +263,8 @@ class NumpyLoader(DataLoader):
 
 
 def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
-  """ Train a score based generative model using stochastic gradient descent
+  """ Train a score based generative model using stochastic gradient descent.
+  Runs on a single host, data parallel over its local devices if `config.training.pmap`.
 
   Args:
     sampling_shape : sampling shape may differ depending on the modality of data
@@ -247,16 +274,30 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
       contains checkpoint training will be resumed from the latest checkpoint.
     use_wandb: Bool. If set to `True`, uses weights and biases to store and visualize loss data.
   """
-  train_dataloader = NumpyLoader(config, dataset)
-  eval_dataloader = NumpyLoader(config, dataset)
-
-  jax.default_device = jax.devices()[0]  # type: ignore
+  # Drop the last partial batch so that every batch has the shape the steps are compiled for
+  train_dataloader = NumpyLoader(config, dataset, drop_last=True)
+  eval_dataloader = NumpyLoader(config, dataset, drop_last=True)
+  if len(train_dataloader) == 0 or len(eval_dataloader) == 0:
+    raise ValueError("dataset of size {} is too small for a single batch of batch_size * n_jitted_steps = {}".format(
+      len(dataset), config.training.batch_size * config.training.n_jitted_steps))
+
+  # jax runs on its default backend, an accelerator if one is available; `export JAX_PLATFORMS=cpu` forces the CPU
   # Tip: use `export CUDA_VISIBLE_DEVICES` to restrict the devices visible to jax
-  # ... devices (GPUs/TPUs) must be all the same model for pmap to work
-  num_devices =  int(jax.local_device_count())
+  # ... devices (GPUs/TPUs) must be all the same model for data parallel training
+  num_devices =  int(jax.local_device_count()) if config.training.pmap else 1
   if jax.process_index()==0: print("num_devices={}, pmap={}".format(
     num_devices, config.training.pmap))
 
+  # The mesh spans this host's devices only, so gradients would not be synchronized across hosts
+  assert jax.process_count() == 1, "train() is single-host only, got {} processes".format(jax.process_count())
+  # Shard the batch axis across devices, parameters and optimizer state are replicated
+  mesh = Mesh(np.array(jax.local_devices()[:num_devices]), ('batch',))
+  replicated = NamedSharding(mesh, P())
+  if config.training.n_jitted_steps > 1:
+    data_sharding = NamedSharding(mesh, P(None, 'batch'))
+  else:
+    data_sharding = NamedSharding(mesh, P('batch'))
+
   # Create directories for experimental logs
   if workdir is not None:
     sample_dir = os.path.join(workdir, "samples")
@@ -268,6 +309,7 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
   # eval_function = dataset.calculate_metrics_batch
   # metric_names = dataset.metric_names()
   if jax.process_index()==0 and use_wandb:
+    import wandb
     run = wandb.init(
       project="diffusionjax",
       config=config,
@@ -291,10 +333,16 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
   state = State(step=0,
     opt_state=opt_state,
     params=params,
-    lr=config.optim.lr,
     rng=rng)
+  # Place the training state on the devices, replicated over the mesh. Checkpoints
+  # are restored straight into this sharding, without a host round trip.
+  state = jax.device_put(state, replicated)
 
   if workdir is not None:
+    # Checkpointing requires orbax, https://orbax.readthedocs.io/en/latest/
+    import orbax.checkpoint
+    import flax.training.orbax_utils as orbax_utils
+
     # Create checkpoints directory
     checkpoint_dir = os.path.join(workdir, "checkpoints")
     if not os.path.exists(checkpoint_dir):
@@ -306,23 +354,25 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
       os.mkdir(checkpoint_meta_dir)
 
     # Orbax checkpointer boilerplate
+    # Checkpoints are indexed by `step // snapshot_freq`, keep the latest five and every tenth
     manager_options = orbax.checkpoint.CheckpointManagerOptions(
-      create=True, max_to_keep=np.inf)
+      create=True, max_to_keep=5, keep_period=10)
     checkpoint_manager = orbax.checkpoint.CheckpointManager(
       checkpoint_dir,
       orbax.checkpoint.Checkpointer(orbax.checkpoint.PyTreeCheckpointHandler()), manager_options)
 
-    # meta_manager_options = orbax.checkpoint.CheckpointManagerOptions(
-    #   create=True, max_to_keep=1)
+    # Only the latest pre-emption checkpoint is needed to resume training
+    meta_manager_options = orbax.checkpoint.CheckpointManagerOptions(
+      create=True, max_to_keep=1)
     meta_checkpoint_manager = orbax.checkpoint.CheckpointManager(
       checkpoint_meta_dir,
-      orbax.checkpoint.Checkpointer(orbax.checkpoint.PyTreeCheckpointHandler()), manager_options)
+      orbax.checkpoint.Checkpointer(orbax.checkpoint.PyTreeCheckpointHandler()), meta_manager_options)
 
     # Resume training when intermediate checkpoints are detected
     restore_args = orbax_utils.restore_args_from_target(state, mesh=None)
     save_step = meta_checkpoint_manager.latest_step()
     if save_step is not None:
-      meta_checkpoint_manager.restore(
+      state = meta_checkpoint_manager.restore(
         save_step,
         items=state, restore_kwargs={'restore_args': restore_args})
 
@@ -341,22 +391,28 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
   loss = get_loss(
     sde, outer_solver, model,
     score_scaling=config.training.score_scaling,
-    likelihood_weighting=config.training.likelihood_weighting)
-  train_step = get_step_fn(loss, optimizer, train=True, pmap=config.training.pmap)
-  eval_step = get_step_fn(loss, optimizer, train=False, pmap=config.training.pmap)
-
-  if config.training.n_jitted_steps > 1:
-    train_step = partial(jax.lax.scan, train_step)
-    eval_step = partial(jax.lax.scan, eval_step)
-
-  if config.training.pmap:
-    train_step = jax.pmap(
-      train_step, axis_name='batch', donate_argnums=1)
-    eval_step = jax.pmap(
-      eval_step, axis_name='batch', donate_argnums=1)
-
-  # Replicate the training state to run on multiple devices
-  if config.training.pmap: state = flax_utils.replicate(state)
+    likelihood_weighting=config.training.likelihood_weighting,
+    remat=config.training.remat)
+  train_step = get_step_fn(
+    loss, optimizer, train=True, n_jitted_steps=config.training.n_jitted_steps)
+  eval_step = get_step_fn(
+    loss, optimizer, train=False, n_jitted_steps=config.training.n_jitted_steps)
+
+  def scaled(step_fn):
+    # Scale the data inside the jitted step so that it fuses with the model forward pass,
+    # and reduce the loss over the jitted steps on the device
+    def scaled_step_fn(state, batch):
+      state, loss_val = step_fn(state, scaler(batch))
+      return state, loss_val.mean()
+    return scaled_step_fn
+
+  # One jit over the (scanned) step, donating the state buffers across all jitted steps
+  train_step = jax.jit(
+    scaled(train_step), in_shardings=(replicated, data_sharding),
+    out_shardings=replicated, donate_argnums=0)
+  eval_step = jax.jit(
+    scaled(eval_step), in_shardings=(replicated, data_sharding),
+    out_shardings=replicated)
 
   # Probably want to train over multiple epochs
   # If num_epochs > num_batch, decides which tqdm to go over
@@ -372,6 +428,18 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
   if jax.process_index() == 0:
     logging.info("Starting training loop at step %d." % (initial_step,))
   rng = jax.random.fold_in(rng, jax.process_index())
+  # Training keys are carried in `state.rng`, evaluation keys are derived from the step,
+  # and both differ between hosts
+  state = state.replace(rng=random.fold_in(state.rng, jax.process_index()))
+  rng, eval_rng = random.split(rng)
+
+  # Compile ahead of time for the fixed batch shape, so the loop never re-traces
+  example_batch = train_dataloader.collate_fn(
+    [dataset[0]] * train_dataloader.batch_size)  # type: ignore
+  example_batch = jax.tree_util.tree_map(
+    lambda x: jax.ShapeDtypeStruct(np.shape(x), np.asarray(x).dtype), example_batch)
+  train_step = train_step.lower(state, example_batch).compile()
+  eval_step = eval_step.lower(state, example_batch).compile()
 
   # JIT multiple training steps together for faster training
   n_jitted_steps = config.training.n_jitted_steps
@@ -382,7 +450,16 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
     config.training.eval_freq % n_jitted_steps == 0 and \
     config.training.snapshot_freq % n_jitted_steps == 0, "Missing logs or checkpoints!"
 
-  mean_losses = jnp.zeros((num_epochs, 1))
+  # Losses are accumulated on the host, avoiding a new device array per batch
+  mean_losses = np.zeros((num_epochs, 1), dtype=np.float32)
+  # The training loss summed over the current log interval, which may span several epochs
+  log_loss = jnp.zeros(())
+  sample_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+  sample_futures = []
+  # A single, endless stream of evaluation batches, prefetched onto the devices.
+  # Unlike `itertools.cycle`, this does not keep a host copy of every batch.
+  eval_iter = prefetch_to_sharding(
+    itertools.chain.from_iterable(itertools.repeat(eval_dataloader)), data_sharding)
   for i_epoch in trange(1, num_epochs + 1, unit="epochs"):
     current_time = time.time()
 
@@ -390,68 +467,44 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
       print("Epoch took {:.1f} seconds".format(current_time - prev_time))
       prev_time = time.time()
 
-    eval_iter = iter(eval_dataloader)
-
     with tqdm(
-      train_dataloader,
+      prefetch_to_sharding(iter(train_dataloader), data_sharding),
+      total=len(train_dataloader),
       unit=" batch",
       disable=True
     ) as tepoch:
       tepoch.set_description(f"Epoch {i_epoch}")
-      losses = jnp.empty((len(tepoch), 1))
-
-      for i_batch, batch in enumerate(tepoch):
-        batch = jax.tree_map(lambda x: scaler(x), batch)
-
-        # Execute one training step
-        if config.training.pmap:
-          rng, *next_rng = jax.random.split(rng, num=jax.local_device_count() + 1)
-          next_rng = jnp.asarray(next_rng)  # type: ignore
-        else:
-          rng, next_rng = jax.random.split(rng, num=2)  # type: ignore
+      # Losses are accumulated on the device, and only read by the host when they are logged
+      epoch_loss = jnp.zeros(())
 
-        (_, params, opt_state), loss_train = train_step(
-          (next_rng, state.params, state.opt_state), batch)
-        state = state.replace(opt_state=opt_state, params=params)  # type: ignore
-
-        if config.training.pmap:
-          loss_train = flax_utils.unreplicate(loss_train).mean()  # returns a single instance of replicated loss array
-        else:
-          loss_train = loss_train.mean()
+      for batch in tepoch:
+        # Execute one training step, annotated so that step boundaries show in profiler traces
+        with jax.profiler.StepTraceAnnotation("train", step_num=step):
+          state, loss_train = train_step(state, batch)
+        epoch_loss = epoch_loss + loss_train
+        log_loss = log_loss + loss_train
+        step += config.training.n_jitted_steps
 
         # Log to console, file and wandb on host 0
-        if jax.process_index()==0:
-          step += config.training.n_jitted_steps
-          losses = losses.at[i_batch].set(loss_train)
-          if step % config.training.log_step_freq==0 and jax.process_index() == 0 and use_wandb:
+        if step % config.training.log_step_freq==0:
+          if jax.process_index() == 0 and use_wandb:
+            loss_train = float(log_loss) / (config.training.log_step_freq // config.training.n_jitted_steps)
             logging.info("step {:d}, training_loss {:.2e}".format(step, loss_train))
+          log_loss = jnp.zeros(())
 
         # Save a temporary checkpoint to resume training after pre-emption (for cloud computing environments) periodically
         if step!=0 and step % config.training.snapshot_freq_for_preemption==0 and jax.process_index()==0:
-          if config.training.pmap:
-            saved_state = flax_utils.unreplicate(state)
-          else:
-            saved_state = state
-          saved_state = saved_state.replace(rng=rng)
+          saved_state = state
           if workdir:
             saved_args = orbax_utils.save_args_from_target(saved_state)
             meta_checkpoint_manager.save(step//config.training.snapshot_freq_for_preemption, saved_state, save_kwargs={'save_args': saved_args})
 
         # Report the loss on an evaluation dataset periodically
         if step % config.training.eval_freq == 0:
-          eval_batch = jax.tree_map(lambda x: scaler(x), next(eval_iter))
-          if config.training.pmap:
-            rng, *next_rng = jax.random.split(rng, num=jax.local_device_count() + 1)
-            next_rng = jnp.asarray(next_rng)  # type: ignore
-          else:
-            rng, next_rng = jax.random.split(rng, num=2)  # type: ignore
-          (_, _, _), loss_eval = eval_step(
-            (next_rng, state.params, state.opt_state), eval_batch)
-
-          if config.training.pmap:
-            loss_eval = flax_utils.unreplicate(loss_eval).mean()
-          else:
-            loss_eval = loss_eval.mean()
+          eval_batch = next(eval_iter)
+          with jax.profiler.TraceAnnotation("eval"):
+            _, loss_eval = eval_step(
+              state.replace(rng=random.fold_in(eval_rng, step)), eval_batch)
 
           if jax.process_index()==0 and use_wandb:
             logging.info("batch: {:d}, eval_loss: {:.5e}".format(step, loss_eval))
@@ -461,11 +514,7 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
         if step != 0 and step % config.training.snapshot_freq == 0 or step == config.training.n_iters:
           # Save the checkpoint
           if jax.process_index()==0:
-            if config.training.pmap:
-              saved_state = flax_utils.unreplicate(state)
-            else:
-              saved_state = state
-            saved_state = saved_state.replace(rng=rng)
+            saved_state = state
             if workdir:
               saved_args = orbax_utils.save_args_from_target(saved_state)
               checkpoint_manager.save(step // config.training.snapshot_freq, saved_state, save_kwargs={'save_args': saved_args})
@@ -473,9 +522,16 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
           # Generate and save samples
           if config.training.snapshot_sampling:
             # Setup solver with new trained score
-            # Use the unreplicated parameters of the saved state
+            sampling_model, sampling_params = model, saved_state.params
+            if config.sampling.bf16_params:
+              # Sampling is inference only, so store the parameters and run the network in bfloat16.
+              # The score is promoted back to float32 by the solver, so the samples stay in float32
+              sampling_model = model.clone(dtype=jnp.bfloat16)
+              sampling_params = jax.tree_util.tree_map(
+                lambda x: x.astype(jnp.bfloat16) if jnp.issubdtype(x.dtype, jnp.floating) else x,
+                sampling_params)
             score = get_score(
-              sde, model, saved_state.params, config.training.score_scaling)
+              sde, sampling_model, sampling_params, config.training.score_scaling)
             outer_solver, inner_solver = get_solver(config, sde, score)
             sampler = get_sampler(sampling_shape, outer_solver,
                                   inner_solver, denoise=config.sampling.denoise,
@@ -483,10 +539,15 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
                                   inverse_scaler=inverse_scaler)
 
             if config.training.pmap:
-              sampler = jax.pmap(sampler, axis_name='batch')
-              rng, *sample_rng = random.split(rng, 1 + jax.local_device_count())
-              sample_rng = jnp.asarray(sample_rng)  # type: ignore
+              # One batch of samples per device, sharded over the device mesh
+              sample_sharding = NamedSharding(mesh, P('batch'))
+              # Named 'batch', like the pmap it replaces, for solvers that reduce over devices (e.g., `Annealed`)
+              sampler = jax.jit(jax.vmap(sampler, axis_name='batch'), in_shardings=sample_sharding)
+              rng, *sample_rng = random.split(rng, 1 + num_devices)
+              sample_rng = jax.device_put(jnp.asarray(sample_rng), sample_sharding)  # type: ignore
             else:
+              # Compile the whole sampler, so the inverse scaler fuses with the final step
+              sampler = jax.jit(sampler)
               rng, sample_rng = random.split(rng, 2)  # type: ignore
 
             sample, _ = sampler(sample_rng)
@@ -500,26 +561,30 @@ def train(sampling_shape, config, dataset, workdir=None, use_wandb=False):
               if not os.path.isdir(this_sample_dir):
                 os.mkdir(this_sample_dir)
 
-              with open(os.path.join(this_sample_dir, "sample.np"), 'wb') as infile:
-                np.save(infile, sample)
+              # Copy to host and write on the background thread, so that training resumes
+              sample_futures.append(sample_writer.submit(
+                save_sample, os.path.join(this_sample_dir, "sample.np"), sample))
+
+            # Release the sampling buffers before training resumes
+            del sampler, sample
 
       if jax.process_index()==0:
-        mean_loss = jnp.mean(losses, axis=0)
+        mean_loss = np.asarray(epoch_loss).reshape(1) / len(tepoch)
 
     if jax.process_index()==0 and i_epoch % config.training.log_epoch_freq==0:
-      mean_losses = mean_losses.at[i_epoch].set(mean_loss)
+      mean_losses[i_epoch - 1] = mean_loss
       if use_wandb:
         logging.info("step {:d}, mean_loss {:.2e}".format(int(step), float(mean_loss[0])))
         wandb.log({"train-loss": mean_loss})
 
-  if workdir and use_wandb:
+  # Wait for the samples to be written, re-raising any errors from the writer thread
+  sample_writer.shutdown(wait=True)
+  for future in sample_futures: future.result()
+
+  if workdir and jax.process_index()==0 and use_wandb:
     artifact = wandb.Artifact(name='checkpoint', type='checkpoint')
     artifact.add_dir(local_path=checkpoint_dir)
     run.log_artifact(artifact)  # type: ignore
 
   # Get the model and do test dataset
-  if config.training.pmap:
-    saved_state = flax_utils.unreplicate(state)
-  else:
-    saved_state = state
-  return saved_state.params, saved_state.opt_state, mean_losses
+  return state.params, state.opt_state, mean_losses
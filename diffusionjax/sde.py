@@ -40,7 +40,7 @@ class VE:
       self.sigma = sigma
     self.sigma_min = self.sigma(0.)
     self.sigma_max = self.sigma(1.)
-    self.std = sigma
+    self.std = self.sigma
 
   def sde(self, x, t):
     sigma_t = self.sigma(t)
@@ -58,6 +58,9 @@ class VE:
   def variance(self, t):
     return self.std(t)**2
 
+  def marginal_prob(self, x, t):
+    return x, self.std(t)
+
   def prior(self, rng, shape):
     return random.normal(rng, shape) * self.sigma_max
 
@@ -106,11 +109,18 @@ class VP:
   def std(self, t):
     return jnp.sqrt(self.variance(t))
 
+  def _variance_from_log_mean_coeff(self, log_mean_coeff):
+    # expm1 avoids the cancellation in 1 - exp(x) for x close to zero, i.e., for small t
+    return -jnp.expm1(2 * log_mean_coeff)
+
   def variance(self, t):
-    return 1.0 - jnp.exp(2 * self.log_mean_coeff(t))
+    return self._variance_from_log_mean_coeff(self.log_mean_coeff(t))
 
   def marginal_prob(self, x, t):
-    return batch_mul(self.mean_coeff(t), x), jnp.sqrt(self.variance(t))
+    log_mean_coeff = self.log_mean_coeff(t)
+    mean = batch_mul(jnp.exp(log_mean_coeff), x)
+    std = jnp.sqrt(self._variance_from_log_mean_coeff(log_mean_coeff))
+    return mean, std
 
   def prior(self, rng, shape):
     return random.normal(rng, shape)
@@ -128,8 +138,9 @@ class VP:
     .. math::
       \text{Variance of }p_{0}(x_{0}|x_{t}) \text{ if } p_{0}(x_{0}) = \mathcal{N}(0, \text{data_variance}I)
     """
-    alpha = jnp.exp(2 * self.log_mean_coeff(t))
-    return (1 - alpha) * data_variance / (1 - alpha + alpha * data_variance)
+    variance = self.variance(t)
+    alpha = 1. - variance
+    return variance * data_variance / (variance + alpha * data_variance)
 
   def ratio(self, t):
     """Ratio of marginal variance and mean coeff."""
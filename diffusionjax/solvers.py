@@ -63,11 +63,12 @@ class EulerMaruyama(Solver):
     super().__init__(ts)
     self.sde = sde
     self.prior = sde.prior
+    self.sqrt_dt = jnp.sqrt(self.dt)
 
   def update(self, rng, x, t):
     drift, diffusion = self.sde.sde(x, t)
     f = drift * self.dt
-    G = diffusion * jnp.sqrt(self.dt)
+    G = diffusion * self.sqrt_dt
     noise = random.normal(rng, x.shape)
     x_mean = x + f
     x = x_mean + batch_mul(G, noise)
@@ -125,10 +126,13 @@ class Inpainted(Solver):
     self.sde = sde
     self.mask = mask
     self.y = y
+    # Neither depends on t, so only compute them once
+    self.mask_complement = 1. - mask
+    self.masked_y = y * mask
 
   def prior(self, rng, shape):
     x = self.sde.prior(rng, shape)
-    x = batch_mul_A((1. - self.mask), x) + self.y * self.mask
+    x = batch_mul_A(self.mask_complement, x) + self.masked_y
     return x
 
   def update(self, rng, x, t):
@@ -136,8 +140,8 @@ class Inpainted(Solver):
     std = jnp.sqrt(self.sde.variance(t))
     masked_data_mean = batch_mul_A(self.y, mean_coeff)
     masked_data = masked_data_mean + batch_mul(random.normal(rng, x.shape), std)
-    x = batch_mul_A((1. - self.mask), x) + batch_mul_A(self.mask, masked_data)
-    x_mean = batch_mul_A((1. - self.mask), x) + batch_mul_A(self.mask, masked_data_mean)
+    x = batch_mul_A(self.mask_complement, x) + batch_mul_A(self.mask, masked_data)
+    x_mean = batch_mul_A(self.mask_complement, x) + batch_mul_A(self.mask, masked_data_mean)
     return x, x_mean
 
 
@@ -157,17 +161,20 @@ class Projected(Solver):
     self.y = y
     self.coeff = coeff
     self.prior = sde.prior
+    # The weights of the data and of the state do not depend on t, so only compute them once
+    self.data_weight = mask * coeff
+    self.x_weight = 1. - self.data_weight
 
-  def merge_data_with_mask(self, x_space, data, mask, coeff):
-    return batch_mul_A(mask * coeff, data) + batch_mul_A((1. - mask * coeff), x_space)
+  def merge_data_with_mask(self, x_space, data):
+    return batch_mul_A(self.data_weight, data) + batch_mul_A(self.x_weight, x_space)
 
   def update(self, rng, x, t):
     mean_coeff = self.sde.mean_coeff(t)
     masked_data_mean = batch_mul_A(self.y, mean_coeff)
     std = jnp.sqrt(self.sde.variance(t))
     z_data = masked_data_mean + batch_mul(std, random.normal(rng, x.shape))
-    x = self.merge_data_with_mask(x, z_data, self.mask, self.coeff)
-    x_mean = self.merge_data_with_mask(x, masked_data_mean, self.mask, self.coeff)
+    x = self.merge_data_with_mask(x, z_data)
+    x_mean = self.merge_data_with_mask(x, masked_data_mean)
     return x, x_mean
 
 
@@ -187,6 +194,12 @@ class DDPM(Solver):
     self.alphas_cumprod_prev = jnp.append(1.0, self.alphas_cumprod[:-1])
     self.sqrt_alphas_cumprod_prev = jnp.sqrt(self.alphas_cumprod_prev)
     self.sqrt_1m_alphas_cumprod_prev = jnp.sqrt(1. - self.alphas_cumprod_prev)
+    # The posterior coefficients only depend on the timestep, so tabulate them once
+    v = self.sqrt_1m_alphas_cumprod**2
+    v_prev = self.sqrt_1m_alphas_cumprod_prev**2
+    self.posterior_x_coeffs = jnp.sqrt(self.alphas) * v_prev / v
+    self.posterior_x_0_coeffs = self.sqrt_alphas_cumprod_prev * self.discrete_betas / v
+    self.posterior_stds = jnp.sqrt(self.discrete_betas * v_prev / v)
 
   def get_estimate_x_0_vmap(self, observation_map):
 
@@ -215,7 +228,6 @@ class DDPM(Solver):
     return random.normal(rng, shape)
 
   def posterior(self, score, x, timestep):
-    beta = self.discrete_betas[timestep]
     # As implemented by Song
     # https://github.com/yang-song/score_sde/blob/0acb9e0ea3b8cccd935068cd9c657318fbc6ce4c/sampling.py#L237C5-L237C79
     # x_mean = batch_mul(
@@ -226,12 +238,9 @@ class DDPM(Solver):
     # https://github.com/DPS2022/diffusion-posterior-sampling/blob/effbde7325b22ce8dc3e2c06c160c021e743a12d/guided_diffusion/gaussian_diffusion.py#L373
     m = self.sqrt_alphas_cumprod[timestep]
     v = self.sqrt_1m_alphas_cumprod[timestep]**2
-    alpha = self.alphas[timestep]
     x_0 = batch_mul((x + batch_mul(v, score)), 1. / m)
-    m_prev = self.sqrt_alphas_cumprod_prev[timestep]
-    v_prev = self.sqrt_1m_alphas_cumprod_prev[timestep]**2
-    x_mean = batch_mul(jnp.sqrt(alpha) * v_prev / v, x) + batch_mul(m_prev * beta / v, x_0)
-    std = jnp.sqrt(beta * v_prev / v)
+    x_mean = batch_mul(self.posterior_x_coeffs[timestep], x) + batch_mul(self.posterior_x_0_coeffs[timestep], x_0)
+    std = self.posterior_stds[timestep]
     return x_mean, std
 
   def update(self, rng, x, t):
@@ -325,6 +334,11 @@ class DDIMVP(Solver):
     self.alphas_cumprod_prev = jnp.append(1.0, self.alphas_cumprod[:-1])
     self.sqrt_alphas_cumprod_prev = jnp.sqrt(self.alphas_cumprod_prev)
     self.sqrt_1m_alphas_cumprod_prev = jnp.sqrt(1. - self.alphas_cumprod_prev)
+    # The posterior coefficients only depend on the timestep, so tabulate them once
+    v = self.sqrt_1m_alphas_cumprod**2
+    v_prev = self.sqrt_1m_alphas_cumprod_prev**2
+    self.posterior_stds = self.eta * jnp.sqrt((v_prev / v) * (1 - self.alphas_cumprod / self.alphas_cumprod_prev))
+    self.posterior_epsilon_coeffs = jnp.sqrt(v_prev - self.posterior_stds**2)
 
   def get_estimate_x_0_vmap(self, observation_map):
 
@@ -360,16 +374,10 @@ class DDIMVP(Solver):
     timestep = get_timestep(t, self.t0, self.t1, self.num_steps)
     m = self.sqrt_alphas_cumprod[timestep]
     sqrt_1m_alpha = self.sqrt_1m_alphas_cumprod[timestep]
-    v = sqrt_1m_alpha**2
-    alpha_cumprod = self.alphas_cumprod[timestep]
-    alpha_cumprod_prev = self.alphas_cumprod_prev[timestep]
     m_prev = self.sqrt_alphas_cumprod_prev[timestep]
-    v_prev = self.sqrt_1m_alphas_cumprod_prev[timestep]**2
     x_0 = batch_mul((x - batch_mul(sqrt_1m_alpha, epsilon)), 1. / m)
-    coeff1 = self.eta * jnp.sqrt((v_prev / v) * (1 - alpha_cumprod / alpha_cumprod_prev))
-    coeff2 = jnp.sqrt(v_prev - coeff1**2)
-    x_mean = batch_mul(m_prev, x_0) + batch_mul(coeff2, epsilon)
-    std = coeff1
+    x_mean = batch_mul(m_prev, x_0) + batch_mul(self.posterior_epsilon_coeffs[timestep], epsilon)
+    std = self.posterior_stds[timestep]
     return x_mean, std
 
   def update(self, rng, x, t):
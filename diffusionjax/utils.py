@@ -3,7 +3,7 @@ loss computation, optimization and sampling.
 """
 import jax.numpy as jnp
 from jax.lax import scan
-from jax import vmap
+from jax import vmap, checkpoint, checkpoint_policies
 import jax.random as random
 from functools import partial
 
@@ -146,9 +146,7 @@ def errors(t, sde, score, rng, data, likelihood_weighting=True):
   Returns:
     A Monte-Carlo approximation to the (likelihood weighted) score errors.
   """
-  m = sde.mean_coeff(t)
-  mean = batch_mul(m, data)
-  std = jnp.sqrt(sde.variance(t))
+  mean, std = sde.marginal_prob(data, t)
   rng, step_rng = random.split(rng)
   noise = random.normal(step_rng, data.shape)
   x = mean + batch_mul(std, noise)
@@ -158,7 +156,7 @@ def errors(t, sde, score, rng, data, likelihood_weighting=True):
     return batch_mul(noise, 1. / std) + score(x, t)
 
 
-def get_loss(sde, solver, model, score_scaling=True, likelihood_weighting=True, reduce_mean=True, pointwise_t=False):
+def get_loss(sde, solver, model, score_scaling=True, likelihood_weighting=True, reduce_mean=True, pointwise_t=False, remat=False):
   """Create a loss function for score matching training.
   Args:
     sde: Instantiation of a valid SDE class.
@@ -168,44 +166,58 @@ def get_loss(sde, solver, model, score_scaling=True, likelihood_weighting=True,
     likelihood_weighting: Bool, set to `True` if likelihood weighting, as described in Song et al. 2020 (https://arxiv.org/abs/2011.13456), is applied.
     reduce_mean: Bool, set to `True` if taking the mean of the errors in the loss, set to `False` if taking the sum.
     pointwise_t: Bool, set to `True` if returning a function that can evaluate the loss pointwise over time. Set to `False` if returns an expectation of the loss over time.
+    remat: Bool, set to `True` to rematerialize the model activations in the backward pass, see `:meth:get_score`.
 
   Returns:
     A loss function that can be used for score matching training.
   """
   reduce_op = jnp.mean if reduce_mean else lambda *args, **kwargs: 0.5 * jnp.sum(*args, **kwargs)
+
+  def loss_at(ts, params, rng, data):
+    """The loss of a batch of data, with the data perturbed to times ts."""
+    score = get_score(sde, model, params, score_scaling, remat=remat)
+    e = errors(ts, sde, score, rng, data, likelihood_weighting)
+    losses = e**2
+    losses = reduce_op(losses.reshape((losses.shape[0], -1)), axis=-1)
+    if likelihood_weighting:
+      g2 = sde.sde(jnp.zeros_like(data), ts)[1]**2
+      losses = losses * g2
+    return jnp.mean(losses)
+
   if pointwise_t:
     def pointwise_loss(t, params, rng, data):
       n_batch = data.shape[0]
       ts = jnp.ones((n_batch,)) * t
-      score = get_score(sde, model, params, score_scaling)
-      e = errors(ts, sde, score, rng, data, likelihood_weighting)
-      losses = e**2
-      losses = reduce_op(losses.reshape((losses.shape[0], -1)), axis=-1)
-      if likelihood_weighting:
-        g2 = sde.sde(jnp.zeros_like(data), ts)[1]**2
-        losses = losses * g2
-      return jnp.mean(losses)
+      return loss_at(ts, params, rng, data)
     return pointwise_loss
   else:
     def loss(params, rng, data):
       rng, step_rng = random.split(rng)
       ts = random.uniform(step_rng, (data.shape[0],), minval=solver.ts[0], maxval=solver.t1)
-      score = get_score(sde, model, params, score_scaling)
-      e = errors(ts, sde, score, rng, data, likelihood_weighting)
-      losses = e**2
-      losses = reduce_op(losses.reshape((losses.shape[0], -1)), axis=-1)
-      if likelihood_weighting:
-        g2 = sde.sde(jnp.zeros_like(data), ts)[1]**2
-        losses = losses * g2
-      return jnp.mean(losses)
+      return loss_at(ts, params, rng, data)
     return loss
 
 
-def get_score(sde, model, params, score_scaling):
+def get_score(sde, model, params, score_scaling, remat=False):
+  """Get the score function of a trained model.
+  Args:
+    sde: Instantiation of a valid SDE class.
+    model: A valid flax neural network `:class:flax.linen.Module` class.
+    params: The model parameters.
+    score_scaling: Bool, set to `True` if the model is a score scaled by the marginal standard deviation.
+    remat: Bool, set to `True` to wrap the model in `jax.checkpoint`, so that only the
+      matrix multiplication outputs are stored for the backward pass and the rest of the
+      activations are recomputed. Trades an extra forward pass for activation memory,
+      only useful when differentiating through the score.
+  Returns:
+    The score, a function taking in (x, t).
+  """
+  apply = checkpoint(
+    model.apply, policy=checkpoint_policies.dots_with_no_batch_dims_saveable) if remat else model.apply
   if score_scaling is True:
-    return lambda x, t: -batch_mul(model.apply(params, x, t), 1. / jnp.sqrt(sde.variance(t)))
+    return lambda x, t: -batch_mul(apply(params, x, t), 1. / jnp.sqrt(sde.variance(t)))
   else:
-    return lambda x, t: -model.apply(params, x, t)
+    return lambda x, t: -apply(params, x, t)
 
 
 def get_epsilon(sde, model, params, score_scaling):
@@ -261,36 +273,38 @@ def get_sampler(shape, outer_solver, inner_solver=None, denoise=True, stack_samp
         inner_ts = inner_solver.ts
         num_function_evaluations = jnp.size(outer_ts) * (jnp.size(inner_ts) + 1)
 
-        def inner_step(carry, t):
-          rng, x, x_mean, vec_t = carry
-          rng, step_rng = random.split(rng)
+        def inner_step(carry, inputs):
+          x, x_mean, vec_t = carry
+          _, step_rng = inputs
           x, x_mean = inner_update(step_rng, x, vec_t)
-          return (rng, x, x_mean, vec_t), ()
+          return (x, x_mean, vec_t), ()
 
-        def outer_step(carry, t):
-          rng, x, x_mean = carry
+        def outer_step(carry, inputs):
+          x, x_mean = carry
+          t, rng = inputs
           vec_t = jnp.full(shape[0], t)
           rng, step_rng = random.split(rng)
           x, x_mean = outer_update(step_rng, x, vec_t)
-          (rng, x, x_mean, vec_t), _ = scan(inner_step, (step_rng, x, x_mean, vec_t), inner_ts)
+          inner_rngs = random.split(rng, inner_ts.shape[0])
+          (x, x_mean, vec_t), _ = scan(inner_step, (x, x_mean, vec_t), (inner_ts, inner_rngs))
           if not stack_samples:
-            return (rng, x, x_mean), ()
+            return (x, x_mean), ()
           else:
             if denoise:
-              return (rng, x, x_mean), x_mean
+              return (x, x_mean), x_mean
             else:
-              return (rng, x, x_mean), x
+              return (x, x_mean), x
     else:
       num_function_evaluations = jnp.size(outer_ts)
-      def outer_step(carry, t):
-        rng, x, x_mean = carry
+      def outer_step(carry, inputs):
+        x, x_mean = carry
+        t, step_rng = inputs
         vec_t = jnp.full((shape[0],), t)
-        rng, step_rng = random.split(rng)
         x, x_mean = outer_update(step_rng, x, vec_t)
         if not stack_samples:
-          return (rng, x, x_mean), ()
+          return (x, x_mean), ()
         else:
-          return ((rng, x, x_mean), x_mean) if denoise else ((rng, x, x_mean), x)
+          return ((x, x_mean), x_mean) if denoise else ((x, x_mean), x)
 
     rng, step_rng = random.split(rng)
     if x_0 is None:
@@ -301,11 +315,13 @@ def get_sampler(shape, outer_solver, inner_solver=None, denoise=True, stack_samp
     else:
       assert(x_0.shape==shape)
       x = x_0
+    # Split the keys for all of the steps up front, rather than once per step of the scan
+    outer_rngs = random.split(rng, outer_ts.shape[0])
     if not stack_samples:
-      (_, x, x_mean), _ = scan(outer_step, (rng, x, x), outer_ts, reverse=True)
+      (x, x_mean), _ = scan(outer_step, (x, x), (outer_ts, outer_rngs), reverse=True)
       return inverse_scaler(x_mean if denoise else x), num_function_evaluations
     else:
-      (_, _, _), xs = scan(outer_step, (rng, x, x), outer_ts, reverse=True)
+      (_, _), xs = scan(outer_step, (x, x), (outer_ts, outer_rngs), reverse=True)
       return inverse_scaler(xs), num_function_evaluations
   # return jax.pmap(sampler, in_axes=(0), axis_name='batch')
   return sampler
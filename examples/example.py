@@ -20,6 +20,7 @@ import diffusionjax.sde as sde_lib
 from absl import app, flags
 from ml_collections.config_flags import config_flags
 from flax import serialization
+import numpy as np
 import time
 import os
 
@@ -58,10 +59,11 @@ class CircleDataset(Dataset):
     Returns:
       An (num_samples, 2) array of samples.
     """
-    alphas = jnp.linspace(0, 2 * jnp.pi * (1 - 1/num_samples), num_samples)
-    xs = jnp.cos(alphas)
-    ys = jnp.sin(alphas)
-    samples = jnp.stack([xs, ys], axis=1)
+    # Kept on the host as NumPy, which is what the data loader collates
+    alphas = np.linspace(0, 2 * np.pi * (1 - 1/num_samples), num_samples, dtype=np.float32)
+    xs = np.cos(alphas)
+    ys = np.sin(alphas)
+    samples = np.stack([xs, ys], axis=1)
     return samples
 
   def metric_names(self):
@@ -84,7 +86,7 @@ class CircleDataset(Dataset):
 def main(argv):
   workdir = FLAGS.workdir
   config = FLAGS.config
-  jax.default_device = jax.devices()[0]
+  # jax runs on its default backend, an accelerator if one is available; JAX_PLATFORMS=cpu forces the CPU
   # Tip: use CUDA_VISIBLE_DEVICES to restrict the devices visible to jax
   # ... they must be all the same model of device for pmap to work
   num_devices =  int(jax.local_device_count()) if config.training.pmap else 1
@@ -112,6 +114,9 @@ def main(argv):
   plot_scatter(
     samples=dataset.train_data, index=(0, 1), fname="samples", lims=((-3, 3), (-3, 3)))
 
+  # Scale the data and put it on the device once, rather than for every evaluation of the score
+  scaled_train_data = scaler(jnp.asarray(dataset.train_data))
+
   def log_hat_pt(x, t):
     """Empirical distribution score.
 
@@ -124,7 +129,7 @@ def main(argv):
         \log\hat{p}_{t}(x)
     """
     mean_coeff = sde.mean_coeff(t)  # argument t can be scalar BatchTracer or JaxArray
-    mean = mean_coeff * scaler(dataset.train_data)
+    mean = mean_coeff * scaled_train_data
     std = jnp.sqrt(sde.variance(t))
     potentials = jnp.sum(-(x - mean)**2 / (2 * std**2), axis=1)
     return logsumexp(potentials, axis=0, b=1/num_samples)
@@ -136,11 +141,11 @@ def main(argv):
   plot_score(score=nabla_log_hat_pt, scaler=scaler, t=0.01, area_bounds=[-3., 3], fname="empirical score")
   ts, _ = get_times(num_steps=config.solver.num_outer_steps, dt=config.solver.dt, t0=config.solver.epsilon)
   outer_solver = EulerMaruyama(sde.reverse(nabla_log_hat_pt), ts)
-  sampler = get_sampler((5760, config.data.image_size),
-                        outer_solver,
-                        denoise=config.sampling.denoise,
-                        stack_samples=False,
-                        inverse_scaler=inverse_scaler)
+  sampler = jit(get_sampler((5760, config.data.image_size),
+                            outer_solver,
+                            denoise=config.sampling.denoise,
+                            stack_samples=False,
+                            inverse_scaler=inverse_scaler))
   rng, sample_rng = random.split(rng, 2)
   q_samples, _ = sampler(sample_rng)
   plot_heatmap(samples=q_samples, area_bounds=[-3., 3.], fname="heatmap empirical score")
@@ -148,10 +153,10 @@ def main(argv):
   # What happens when I perturb the score with a constant?
   perturbed_score = lambda x, t: nabla_log_hat_pt(x, t) + 1.
   outer_solver = EulerMaruyama(sde.reverse(perturbed_score), ts)
-  sampler = get_sampler((5760, config.data.image_size),
-                        outer_solver,
-                        denoise=config.sampling.denoise,
-                        inverse_scaler=inverse_scaler)
+  sampler = jit(get_sampler((5760, config.data.image_size),
+                            outer_solver,
+                            denoise=config.sampling.denoise,
+                            inverse_scaler=inverse_scaler))
   rng, sample_rng = random.split(rng, 2)
   q_samples, _ = sampler(sample_rng)
   plot_heatmap(samples=q_samples, area_bounds=[-3., 3.], fname="heatmap bounded perturbation")
@@ -183,11 +188,11 @@ def main(argv):
   trained_score = get_score(sde, get_model(config), params, score_scaling=config.training.score_scaling)
   plot_score(score=trained_score, scaler=scaler, t=0.01, area_bounds=[-3., 3.], fname="trained score")
   outer_solver = EulerMaruyama(sde.reverse(trained_score), ts)
-  sampler = get_sampler(
+  sampler = jit(get_sampler(
     (config.eval.batch_size // num_devices, config.data.image_size),
     outer_solver,
     denoise=config.sampling.denoise,
-    inverse_scaler=inverse_scaler)
+    inverse_scaler=inverse_scaler))
 
   if config.training.pmap:
     sampler = jax.pmap(sampler, axis_name='batch')
@@ -210,23 +215,23 @@ def main(argv):
   y = scaler(y)
 
   # Get inpainter
-  sampler = get_sampler(sampling_shape,
-                        outer_solver,
-                        Inpainted(rsde, mask, y),
-                        inverse_scaler=inverse_scaler,
-                        stack_samples=False,
-                        denoise=True)
+  sampler = jit(get_sampler(sampling_shape,
+                            outer_solver,
+                            Inpainted(rsde, mask, y),
+                            inverse_scaler=inverse_scaler,
+                            stack_samples=False,
+                            denoise=True))
   q_samples, _ = sampler(sample_rng)
   q_samples = q_samples.reshape(sampling_shape)
   plot_heatmap(samples=q_samples, area_bounds=[-3., 3.], fname="heatmap inpainted")
 
   # Get projection sampler
-  sampler = get_sampler(sampling_shape,
-                        outer_solver,
-                        Inpainted(rsde, mask, y),
-                        inverse_scaler=inverse_scaler,
-                        stack_samples=False,
-                        denoise=True)
+  sampler = jit(get_sampler(sampling_shape,
+                            outer_solver,
+                            Projected(rsde, mask, y, coeff=1e-2),
+                            inverse_scaler=inverse_scaler,
+                            stack_samples=False,
+                            denoise=True))
   q_samples, _ = sampler(sample_rng)
   q_samples = q_samples.reshape(sampling_shape)
   plot_heatmap(samples=q_samples, area_bounds=[-3., 3.], fname="heatmap projected")
@@ -236,12 +241,12 @@ def main(argv):
 
   y = jnp.tile(y, (sampling_shape[0], 1))
   # Get pseudo-inverse-guidance sampler
-  sampler = get_sampler(sampling_shape,
-                        EulerMaruyama(sde.reverse(trained_score).guide(
-                          get_pseudo_inverse_guidance, observation_map, y, config.sampling.noise_std)),
-                        inverse_scaler=inverse_scaler,
-                        stack_samples=False,
-                        denoise=True)
+  sampler = jit(get_sampler(sampling_shape,
+                            EulerMaruyama(sde.reverse(trained_score).guide(
+                              get_pseudo_inverse_guidance, observation_map, y, config.sampling.noise_std)),
+                            inverse_scaler=inverse_scaler,
+                            stack_samples=False,
+                            denoise=True))
   q_samples, _ = sampler(sample_rng)
   q_samples = q_samples.reshape(sampling_shape)
   plot_heatmap(samples=q_samples, area_bounds=[-3., 3.], fname="heatmap guided")
@@ -1,4 +1,5 @@
 """Diffusion models introduction. An example using 1 dimensional image data."""
+import jax
 from jax import vmap, jit, grad, value_and_grad
 import jax.random as random
 import jax.numpy as jnp
@@ -57,23 +58,39 @@ def retrain_nn(
   train_size = samples.shape[0]
   batch_size = min(train_size, batch_size)
   steps_per_epoch = train_size // batch_size
-  mean_losses = jnp.zeros((num_epochs, 1))
-  for i in range(num_epochs):
-    rng, step_rng = random.split(step_rng)
-    perms = random.permutation(step_rng, train_size)
-    perms = perms[:steps_per_epoch * batch_size]  # skip incomplete batch
-    perms = perms.reshape((steps_per_epoch, batch_size))
-    losses = jnp.zeros((jnp.shape(perms)[0], 1))
-    for j, perm in enumerate(perms):
-      batch = samples[perm, :]
+
+  @jit  # Scan over all of the epochs, so that training is a single call to XLA
+  def train(params, opt_state, samples, rngs):
+
+    def epoch_step(carry, inputs):
+      params, opt_state = carry
+      i, rng = inputs
       rng, step_rng = random.split(rng)
-      loss_eval, params, opt_state = update_step(params, step_rng, batch, opt_state, loss)
-      losses = losses.at[j].set(loss_eval)
-    mean_loss = jnp.mean(losses, axis=0)
-    mean_losses = mean_losses.at[i].set(mean_loss)
-    if i % 10 == 0:
-      print("Epoch {:d}, Loss {:.2f} ".format(i, mean_loss[0]))
-  return params, opt_state, mean_losses
+      perms = random.permutation(step_rng, train_size)
+      perms = perms[:steps_per_epoch * batch_size]  # skip incomplete batch
+      perms = perms.reshape((steps_per_epoch, batch_size))
+
+      def batch_step(carry, inputs):
+        params, opt_state = carry
+        perm, step_rng = inputs
+        batch = samples[perm, :]
+        loss_eval, params, opt_state = update_step(params, step_rng, batch, opt_state, loss)
+        return (params, opt_state), loss_eval
+
+      (params, opt_state), losses = jax.lax.scan(
+        batch_step, (params, opt_state), (perms, random.split(rng, steps_per_epoch)))
+      mean_loss = jnp.mean(losses)
+      jax.lax.cond(
+        i % 10 == 0,
+        lambda: jax.debug.print("Epoch {:d}, Loss {:.2f} ", i, mean_loss),
+        lambda: None)
+      return (params, opt_state), mean_loss
+
+    return jax.lax.scan(epoch_step, (params, opt_state), (jnp.arange(num_epochs), rngs))
+
+  (params, opt_state), mean_losses = train(
+    params, opt_state, samples, random.split(step_rng, num_epochs))
+  return params, opt_state, mean_losses.reshape((num_epochs, 1))
 
 
 def sample_image_rgb(rng, num_samples, image_size, kernel, num_channels=1):
@@ -177,7 +194,7 @@ def main():
   rsde = sde.reverse(trained_score)
   outer_solver = EulerMaruyama(rsde)
   sampling_shape = (512, image_size, num_channels)
-  sampler = get_sampler(sampling_shape, outer_solver, denoise=True)
+  sampler = jit(get_sampler(sampling_shape, outer_solver, denoise=True))
 
   rng, sample_rng = random.split(rng, 2)
   q_samples, num_function_evaluations = sampler(sample_rng)
@@ -195,31 +212,31 @@ def main():
   mask = mask.at[[0, -1], 0].set([1., 1.])
 
   # Get inpainting sampler
-  sampler = get_sampler(sampling_shape,
-                        outer_solver,
-                        Inpainted(rsde, mask, y),
-                        stack_samples=False,
-                        denoise=True)
+  sampler = jit(get_sampler(sampling_shape,
+                            outer_solver,
+                            Inpainted(rsde, mask, y),
+                            stack_samples=False,
+                            denoise=True))
   q_samples, _ = sampler(sample_rng)
   plot_samples_1D(q_samples, image_size=image_size, x_max=x_max, fname="samples inpainted")
 
   # Get projection sampler
-  sampler = get_sampler(sampling_shape,
-                        outer_solver,
-                        Projected(rsde, mask, y, coeff=1e-2),
-                        stack_samples=False,
-                        denoise=True)
+  sampler = jit(get_sampler(sampling_shape,
+                            outer_solver,
+                            Projected(rsde, mask, y, coeff=1e-2),
+                            stack_samples=False,
+                            denoise=True))
   q_samples, _ = sampler(sample_rng)
   plot_samples_1D(q_samples, image_size=image_size, x_max=x_max, fname="samples projected")
 
   def observation_map(x): return mask * x
 
   # Get pseudo-inverse-guidance sampler
-  sampler = get_sampler(sampling_shape,
-                        EulerMaruyama(rsde.guide(
-                          get_pseudo_inverse_guidance, observation_map, y, noise_std=1e-5)),
-                        stack_samples=False,
-                        denoise=True)
+  sampler = jit(get_sampler(sampling_shape,
+                            EulerMaruyama(rsde.guide(
+                              get_pseudo_inverse_guidance, observation_map, y, noise_std=1e-5)),
+                            stack_samples=False,
+                            denoise=True))
   q_samples, _ = sampler(sample_rng)
   q_samples = q_samples.reshape(sampling_shape)
   plot_samples_1D(q_samples, image_size=image_size, x_max=x_max, fname="samples guided")
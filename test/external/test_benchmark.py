@@ -73,7 +73,7 @@ class CircleDataset(Dataset):
 
 def main(argv):
   config = FLAGS.config
-  jax.default_device = jax.devices()[0]
+  # jax runs on its default backend, an accelerator if one is available; JAX_PLATFORMS=cpu forces the CPU
   # Tip: use CUDA_VISIBLE_DEVICES to restrict the devices visible to jax
   # ... they must be all the same model of device for pmap to work
   num_devices =  int(jax.local_device_count()) if config.training.pmap else 1
@@ -2,6 +2,8 @@ import pytest
 from diffusionjax.utils import (
   batch_mul, get_times, get_linear_beta_function, get_timestep,
   continuous_to_discrete, get_sigma_function)
+from diffusionjax.sde import VE, VP
+import numpy as np
 import jax.numpy as jnp
 from jax import vmap
 
@@ -9,11 +11,10 @@ from jax import vmap
 def test_batch_mul():
     """Placeholder test for `:meth:batch_mul` to test CI"""
     a = jnp.ones((2,)) * 2.
-    bs = [jnp.zeros((2,)), jnp.ones((2,)), jnp.ones((2,)) * jnp.pi]
-    c_expecteds = [jnp.zeros((2,)), 2. * jnp.ones((2,)), 2. * jnp.ones((2,)) * jnp.pi]
-    for i, b in enumerate(bs):
-        c = batch_mul(a, b)
-        assert jnp.allclose(c, c_expecteds[i])
+    bs = jnp.stack([jnp.zeros((2,)), jnp.ones((2,)), jnp.ones((2,)) * jnp.pi])
+    c_expecteds = jnp.stack([jnp.zeros((2,)), 2. * jnp.ones((2,)), 2. * jnp.ones((2,)) * jnp.pi])
+    cs = vmap(lambda b: batch_mul(a, b))(bs)
+    assert jnp.allclose(cs, c_expecteds)
 
 
 def test_continuous_discrete_equivalence_linear_beta_schedule():
@@ -49,105 +50,71 @@ def test_continuous_discrete_equivalence_sigma_schedule():
   assert jnp.allclose(expected_discrete_sigmas, actual_discrete_sigmas)
 
 
-def test_get_timestep_continuous():
+def unit(ts):
+  t0 = ts[0]
+  t1 = ts[-1]
+  t = ts[0]
+  num_steps = jnp.size(ts)
+  timestep = get_timestep(t, t0, t1, num_steps)
+  assert timestep == 0
 
-  def unit(ts):
-    t0 = ts[0]
-    t1 = ts[-1]
-    t = ts[0]
-    num_steps = jnp.size(ts)
-    timestep = get_timestep(t, t0, t1, num_steps)
-    assert timestep == 0
+  t = ts[-1]
+  timestep = get_timestep(t, t0, t1, num_steps)
+  assert timestep == num_steps - 1
 
-    t = ts[-1]
-    timestep = get_timestep(t, t0, t1, num_steps)
-    assert timestep == num_steps - 1
+  t = ts[num_steps - num_steps//2]
+  timestep = get_timestep(t, t0, t1, num_steps)
+  assert timestep == num_steps - num_steps//2
 
-    t = ts[num_steps - num_steps//2]
-    timestep = get_timestep(t, t0, t1, num_steps)
-    assert timestep == num_steps - num_steps//2
-
-  ts, dt = get_times()
-  ts = ts.flatten()
-  assert jnp.size(ts) == 1000
-  assert jnp.isclose(ts[1] - ts[0], 0.001)
-  assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.001
-  assert ts[-1] == 1.0
-  unit(ts)
-
-  ts, dt = get_times(dt=0.1)
-  ts = ts.flatten()
-  assert jnp.size(ts) == 1000
-  assert jnp.isclose(ts[1] - ts[0], 0.1)
-  assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.1
-  assert ts[-1] == 0.1 * 1000
-  unit(ts)
-
-  ts, dt = get_times(t0=0.01)
-  ts = ts.flatten()
-  assert jnp.size(ts) == 1000
-  assert jnp.isclose(ts[1] - ts[0], (1.0 - 0.01) / (1000 - 1))
-  assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.01
-  assert ts[-1] == 1.0
-  unit(ts)
-
-  ts, dt = get_times(dt=0.1, t0=0.01)
-  ts = ts.flatten()
-  assert jnp.size(ts) == 1000
-  assert jnp.isclose(ts[1] - ts[0], 0.1)
-  assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.01
-  assert ts[-1] == 0.1 * (1000 - 1) + 0.01
-  unit(ts)
-
-  ts, dt = get_times(num_steps=100, dt=0.1, t0=0.01)
-  ts = ts.flatten()
-  assert jnp.size(ts) == 100
-  assert jnp.isclose(ts[1] - ts[0], 0.1)
-  assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.01
-  assert ts[-1] == 0.1 * (100 - 1) + 0.01
-  unit(ts)
 
+@pytest.mark.parametrize("kwargs, num_steps, expected_dt, expected_t0, expected_t1, exact_dt", [
+  ({}, 1000, 0.001, 0.001, 1.0, False),
+  ({"dt": 0.1}, 1000, 0.1, 0.1, 0.1 * 1000, False),
+  ({"t0": 0.01}, 1000, (1.0 - 0.01) / (1000 - 1), 0.01, 1.0, False),
+  ({"dt": 0.1, "t0": 0.01}, 1000, 0.1, 0.01, 0.1 * (1000 - 1) + 0.01, False),
+  ({"num_steps": 100, "dt": 0.1, "t0": 0.01}, 100, 0.1, 0.01, 0.1 * (100 - 1) + 0.01, False),
   # Catch any rounding errors for low number of steps
-
-  ts, dt = get_times(num_steps=10)
+  ({"num_steps": 10}, 10, 0.1, 0.1, 1.0, True),
+  ({"dt": 0.05, "num_steps": 10}, 10, 0.05, 0.05, 0.05 * 10, True),
+  ({"t0": 0.01, "num_steps": 10}, 10, (1.0 - 0.01) / (10 - 1), 0.01, 1.0, False),
+  ({"dt": 0.1, "t0": 0.01, "num_steps": 10}, 10, 0.1, 0.01, 0.1 * (10 - 1) + 0.01, True),
+  # The final time must be hit exactly, whatever the number of steps, although the first time may be rounded
+  ({"num_steps": 41}, 41, 1. / 41, 1. / 41, 1.0, False),
+  ({"num_steps": 47}, 47, 1. / 47, 1. / 47, 1.0, False),
+  ({"num_steps": 55}, 55, 1. / 55, 1. / 55, 1.0, False),
+  ({"num_steps": 61}, 61, 1. / 61, 1. / 61, 1.0, False),
+  ({"num_steps": 82}, 82, 1. / 82, 1. / 82, 1.0, False),
+  ({"dt": 0.01, "num_steps": 10}, 10, 0.01, pytest.approx(0.01, rel=1e-6), 0.01 * 10, False),
+  ({"dt": 0.1, "num_steps": 100}, 100, 0.1, pytest.approx(0.1, rel=1e-6), 0.1 * 100, False),
+])
+def test_get_timestep_continuous(kwargs, num_steps, expected_dt, expected_t0, expected_t1, exact_dt):
+  ts, dt = get_times(**kwargs)
   ts = ts.flatten()
-  assert jnp.size(ts) == 10
-  assert ts[1] - ts[0] == 0.1
+  assert jnp.size(ts) == num_steps
+  if exact_dt:
+    assert ts[1] - ts[0] == expected_dt
+  else:
+    assert jnp.isclose(ts[1] - ts[0], expected_dt)
   assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.1
-  assert ts[-1] == 1.0
-  unit(ts)
-
-  ts, dt = get_times(dt=0.05, num_steps=10)
-  ts = ts.flatten()
-  assert jnp.size(ts) == 10
-  assert ts[1] - ts[0] == 0.05
-  assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.05
-  assert ts[-1] == 0.05 * 10
-  unit(ts)
-
-  ts, dt = get_times(t0=0.01, num_steps=10)
-  ts = ts.flatten()
-  assert jnp.size(ts) == 10
-  assert jnp.isclose(ts[1] - ts[0], (1.0 - 0.01) / (10 - 1))
-  assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.01
-  assert ts[-1] == 1.0
-  unit(ts)
-
-  ts, dt = get_times(dt=0.1, t0=0.01, num_steps=10)
-  ts = ts.flatten()
-  assert jnp.size(ts) == 10
-  assert ts[1] - ts[0] == 0.1
-  assert jnp.isclose(ts[1] - ts[0], dt)
-  assert ts[0] == 0.01
-  assert ts[-1] == 0.1 * (10 - 1) + 0.01
+  assert ts[0] == expected_t0
+  assert ts[-1] == expected_t1
   unit(ts)
 
 
+def test_vp_variance_small_t():
+  beta_min = .1
+  beta_max = 20.
+  t = 1e-6
+  # Analytic variance 1 - exp(2 * log_mean_coeff(t)), evaluated in float64
+  expected_variance = -np.expm1(2 * (-0.5 * t * beta_min - 0.25 * t**2 * (beta_max - beta_min)))
+  assert jnp.allclose(VP().variance(t), expected_variance, rtol=1e-5, atol=0.)
+
+
+@pytest.mark.parametrize("sde", [VE(), VP()])
+def test_marginal_prob(sde):
+  ts, _ = get_times(num_steps=10)
+  t = ts.flatten()
+  x = jnp.ones((10, 2)) * jnp.pi
+  mean, std = sde.marginal_prob(x, t)
+  assert jnp.allclose(mean, batch_mul(sde.mean_coeff(t), x))
+  assert jnp.allclose(std, jnp.sqrt(sde.variance(t)))